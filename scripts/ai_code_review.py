@@ -1,93 +1,479 @@
 import os
-import json
+import ast
+import asyncio
+import hashlib
+import importlib.util
+import io
 import pathlib
-from openai import OpenAI
+from functools import lru_cache
+import httpx
+import orjson
+from openai import AsyncOpenAI
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-ALLOWED_EXTENSIONS = {".py", ".js", ".ts", ".go", ".java", ".rb", ".php"}
+# Upper bound on review requests in flight at once, to stay under rate limits
+MAX_CONCURRENT_REVIEWS = int(os.getenv("AI_REVIEW_CONCURRENCY", "8"))
 
+# Submit reviews through the Batch API instead of live requests: cheaper,
+# but results may take anywhere up to the completion window to arrive
+USE_BATCH_API = os.getenv("AI_REVIEW_BATCH") == "1"
+BATCH_POLL_SECONDS = 30
+
+# Reviews are cached per section by a hash of the model, prompt and section
+# content, so unchanged code is never sent to the API twice
+CACHE_DIR = pathlib.Path(os.getenv("AI_REVIEW_CACHE_DIR", ".ai-review-cache"))
+# Bumped whenever the shape of a cached review changes
+REVIEW_CACHE_VERSION = 3
+
+# Files above MAX_FILE_BYTES (on disk) are skipped outright; Python files
+# above CHUNK_CHARS (decoded characters) are reviewed in pieces split at
+# top-level statements
+MAX_FILE_BYTES = 100 * 1024
+CHUNK_CHARS = 16 * 1024
+
+# Several files (or chunks) share one request, up to these limits per group,
+# so the instructions and round-trip are paid once per group. The section
+# cap keeps the scaled output budget under the model's completion limit.
+REVIEW_GROUP_CHARS = 32 * 1024
+REVIEW_GROUP_SECTIONS = 10
+
+REVIEW_MODEL = "gpt-4o-mini"
+
+REVIEW_INSTRUCTIONS = """
+You are an expert software engineer. Review each of the following sections
+of source code for:
+- bugs
+- security issues
+- code smells
+- missing edge cases
+- readability problems
+- opportunities for simplification
+
+Each section is delimited by "=== SECTION <id> ===" and
+"=== END SECTION <id> ===" lines, and every source line is prefixed with
+its line number in the file. Report each finding against that number.
+"""
+
+# Structured output schema, so the model is constrained to valid JSON
+# at decode time rather than asked for it in the prompt
+REVIEW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sections": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "comments": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "line": {"type": "integer"},
+                                "comment": {"type": "string"},
+                            },
+                            "required": ["line", "comment"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["id", "comments"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["sections"],
+    "additionalProperties": False,
+}
+
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+# The event payload is constant for a run, so it is parsed once here.
+# EVENT stays empty when not running inside GitHub Actions.
+GITHUB_EVENT_PATH = os.getenv("GITHUB_EVENT_PATH")
+if GITHUB_EVENT_PATH and pathlib.Path(GITHUB_EVENT_PATH).exists():
+    EVENT = orjson.loads(pathlib.Path(GITHUB_EVENT_PATH).read_bytes())
+else:
+    EVENT = {}
+PR_NUMBER = EVENT.get("number")
+REPO = os.getenv("GITHUB_REPOSITORY")
+
+# One pooled client for every GitHub API call, so requests share a connection.
+# HTTP/2 needs the optional h2 package (pip install "httpx[http2]");
+# without it the client falls back to HTTP/1.1 keep-alive.
+GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+github_headers = {"Accept": "application/vnd.github+json"}
+if GITHUB_TOKEN:
+    github_headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+
+github = httpx.Client(
+    base_url=GITHUB_API_URL,
+    headers=github_headers,
+    http2=importlib.util.find_spec("h2") is not None,
+)
+
+ALLOWED_EXTENSIONS = frozenset({"py", "js", "ts", "go", "java", "rb", "php"})
+
+@lru_cache(maxsize=None)
 def load_changed_files():
     """
-    Reads the GitHub event payload to extract changed files in the PR.
+    Uses the GitHub event payload to extract changed files in the PR.
     Works for pull_request and pull_request_target events.
+    The result is constant for a run, so it is fetched only once.
     """
-    event_path = os.getenv("GITHUB_EVENT_PATH")
-    if not event_path or not pathlib.Path(event_path).exists():
+    if not EVENT:
         raise RuntimeError("GITHUB_EVENT_PATH not found. Are you running inside GitHub Actions?")
 
-    with open(event_path, "r", encoding="utf-8") as f:
-        event = json.load(f)
-
     # GitHub provides changed files under the "pull_request" → "files" API,
     # but the event payload does NOT include them directly.
-    # So we rely on the GitHub CLI (gh) or fallback to reviewing all files.
-    pr_number = event.get("number")
-    repo = os.getenv("GITHUB_REPOSITORY")
-
-    if not pr_number or not repo:
+    # So we query the REST API, which lists every file in one paginated call.
+    if not PR_NUMBER or not REPO:
         raise RuntimeError("Missing PR number or repository info.")
 
-    # Use GitHub CLI to fetch changed files
-    import subprocess
-    result = subprocess.run(
-        ["gh", "pr", "view", str(pr_number), "--repo", repo, "--json", "files"],
-        capture_output=True,
-        text=True
-    )
+    url = f"/repos/{REPO}/pulls/{PR_NUMBER}/files"
+    params = {"per_page": 100}
 
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to fetch PR files: {result.stderr}")
+    files = []
+    while url:
+        response = github.get(url, params=params)
+        if response.status_code != 200:
+            hint = "" if GITHUB_TOKEN else " (GITHUB_TOKEN is not set)"
+            raise RuntimeError(f"Failed to fetch PR files{hint}: {response.text}")
 
-    data = json.loads(result.stdout)
-    files = [f["path"] for f in data.get("files", [])]
+        files.extend(f["filename"] for f in orjson.loads(response.content))
+        # The "next" link is absolute and already carries the query string
+        url = response.links.get("next", {}).get("url")
+        params = None
 
-    return files
+    # A tuple, since the cached result is shared between callers
+    return tuple(files)
 
 
 def filter_source_files(files):
     """Return only files with allowed extensions."""
-    filtered = []
-    for f in files:
-        ext = pathlib.Path(f).suffix
-        if ext in ALLOWED_EXTENSIONS:
-            filtered.append(f)
-    return filtered
+    return [f for f in files if _extension(f) in ALLOWED_EXTENSIONS]
+
+
+def _extension(path):
+    # Same rules as pathlib's suffix: no dot, or a leading-dot name such
+    # as ".rb", means there is no extension
+    head, sep, ext = path.rpartition(".")
+    if not sep or not head or head.endswith("/") or "/" in ext:
+        return ""
+    return ext
 
 
-def review_file(path):
-    """Send a single file to the LLM for review."""
+def split_lines(content):
+    """
+    Split text into lines on "\n" only, keeping the line endings.
+    Unlike str.splitlines, form feeds, U+2028 and friends do not start a
+    new line, so indexes agree with ast and editor line numbers.
+    """
+    return io.StringIO(content).readlines()
+
+
+def split_python_chunks(content):
+    """
+    Split Python source into (first_line, last_line) ranges of roughly
+    CHUNK_CHARS each, only breaking between top-level statements.
+    """
+    lines = split_lines(content)
     try:
-        content = pathlib.Path(path).read_text(encoding="utf-8")
-    except Exception as e:
-        return f"Could not read {path}: {e}"
+        tree = ast.parse(content)
+    except SyntaxError:
+        return [(1, len(lines))]
 
-    prompt = f"""
-You are an expert software engineer. Review the following file for:
-- bugs
-- security issues
-- code smells
-- missing edge cases
-- readability problems
-- opportunities for simplification
+    # offsets[i] is the character count of everything before line i + 1
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
 
-Respond with a structured list of findings.
+    ranges = []
+    start = 1
+    for node in tree.body:
+        end = node.end_lineno
+        if offsets[end] - offsets[start - 1] >= CHUNK_CHARS:
+            ranges.append((start, end))
+            start = end + 1
+    if start <= len(lines):
+        ranges.append((start, len(lines)))
+    return ranges
 
-FILE PATH: {path}
-FILE CONTENT:
-{content}
-"""
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=800
+def build_sections(path):
+    """
+    Read a file and split it into the sections sent for review.
+    Each section is a dict with its id, path, line range and content.
+    """
+    file_path = pathlib.Path(path)
+    size = file_path.stat().st_size
+    if size > MAX_FILE_BYTES:
+        raise ValueError(f"file is {size} bytes, over the {MAX_FILE_BYTES} byte limit")
+
+    content = file_path.read_text(encoding="utf-8")
+    lines = split_lines(content)
+
+    if file_path.suffix == ".py" and len(content) > CHUNK_CHARS:
+        ranges = split_python_chunks(content)
+    else:
+        ranges = [(1, len(lines))]
+
+    return [
+        {
+            "id": f"{path}#L{first}",
+            "path": path,
+            "first": first,
+            "last": last,
+            "content": "".join(lines[first - 1:last]),
+        }
+        for first, last in ranges
+    ]
+
+
+def group_sections(sections):
+    """Pack sections into groups within the REVIEW_GROUP_* limits."""
+    groups = []
+    current = []
+    size = 0
+    for section in sections:
+        if current and (
+            size + len(section["content"]) > REVIEW_GROUP_CHARS
+            or len(current) >= REVIEW_GROUP_SECTIONS
+        ):
+            groups.append(current)
+            current = []
+            size = 0
+        current.append(section)
+        size += len(section["content"])
+    if current:
+        groups.append(current)
+    return groups
+
+
+def build_group_request(group):
+    """Build the chat completion request body reviewing a group of sections."""
+    parts = []
+    for section in group:
+        numbered = "".join(
+            f"{number}: {line}"
+            for number, line in enumerate(
+                split_lines(section["content"]), start=section["first"]
+            )
+        )
+        parts.append(
+            f"=== SECTION {section['id']} ===\n"
+            f"FILE PATH: {section['path']}\n"
+            f"{numbered}\n"
+            f"=== END SECTION {section['id']} ==="
+        )
+
+    return {
+        "model": REVIEW_MODEL,
+        "messages": [
+            {"role": "system", "content": REVIEW_INSTRUCTIONS},
+            {"role": "user", "content": "\n\n".join(parts)},
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "review", "schema": REVIEW_SCHEMA, "strict": True},
+        },
+        # The output budget is per section, as it was per file before grouping
+        "max_tokens": 800 * len(group),
+    }
+
+
+def parse_group_response(content, finish_reason):
+    """Return the section id -> findings mapping from a model response."""
+    # The schema guarantees valid JSON unless the model refused or ran out
+    # of tokens; those sections are then reported as missing
+    if content is None or finish_reason != "stop":
+        print(f"Incomplete review response (finish reason: {finish_reason}).")
+        return {}
+
+    data = orjson.loads(content)
+    # Findings are grouped as section id -> line -> [comment, ...]; a
+    # section listed more than once adds to its findings, not replaces them
+    reviews = {}
+    for section in data["sections"]:
+        by_line = reviews.setdefault(section["id"], {})
+        for item in section["comments"]:
+            by_line.setdefault(int(item["line"]), []).append(item["comment"])
+    return reviews
+
+
+def format_file_review(sections, reviews):
+    """Merge the per-section findings of a file into a single report."""
+    findings = {}
+    report = []
+    for section in sections:
+        section_findings = reviews.get(section["id"])
+        if section_findings is None:
+            report.append(f"No review returned for lines {section['first']}-{section['last']}.")
+        else:
+            for line, comments in section_findings.items():
+                findings.setdefault(line, []).extend(comments)
+
+    report.extend(
+        f"- Line {line}: {comment}"
+        for line, comments in sorted(findings.items())
+        for comment in comments
     )
+    return "\n".join(report) or "No findings."
+
+
+def _cache_path(section):
+    # Keyed on everything that shapes the review, but not on which other
+    # sections happened to share its request
+    key_data = [REVIEW_CACHE_VERSION, REVIEW_MODEL, REVIEW_INSTRUCTIONS, REVIEW_SCHEMA, section]
+    key = hashlib.sha256(orjson.dumps(key_data, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return CACHE_DIR / key[:2] / key
+
+
+def load_cached_review(section):
+    """Return the cached review for this section, or None on a miss."""
+    path = _cache_path(section)
+    if not path.exists():
+        return None
+    # Mark the entry as used so the workflow's prune step keeps it
+    path.touch()
+    # JSON object keys are strings; findings are keyed by int line number
+    cached = orjson.loads(path.read_bytes())
+    return {int(line): comment for line, comment in cached.items()}
+
+
+def store_cached_review(section, review):
+    path = _cache_path(section)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(orjson.dumps(review, option=orjson.OPT_NON_STR_KEYS))
+
+
+def prepare_reviews(paths):
+    """
+    Split files into sections and resolve what the cache already knows.
+    Returns (errors, file_sections, reviews, pending): per-file error
+    messages, each file's sections, cached reviews by section id, and the
+    sections that still need to be sent to the LLM.
+    """
+    errors = {}
+    file_sections = {}
+    reviews = {}
+    pending = []
+    for path in paths:
+        try:
+            sections = build_sections(path)
+        except Exception as e:
+            errors[path] = f"Could not review {path}: {e}"
+            continue
+
+        file_sections[path] = sections
+        for section in sections:
+            cached = load_cached_review(section)
+            if cached is not None:
+                reviews[section["id"]] = cached
+            else:
+                pending.append(section)
+
+    return errors, file_sections, reviews, pending
 
-    return response.choices[0].message["content"]
 
+def store_group_reviews(group, reviews):
+    """Cache the reviews the model returned for a group's sections."""
+    for section in group:
+        if section["id"] in reviews:
+            store_cached_review(section, reviews[section["id"]])
 
-def run_review():
+
+async def review_group(group, sem):
+    """Send a group of sections to the LLM in a single request."""
+    async with sem:
+        response = await client.chat.completions.create(**build_group_request(group))
+
+    choice = response.choices[0]
+    reviews = parse_group_response(choice.message.content, choice.finish_reason)
+    store_group_reviews(group, reviews)
+    return reviews
+
+
+async def review_files(paths):
+    """
+    Review all files with live requests, sending groups concurrently.
+    Returns one result per path, in the same order as `paths`.
+    """
+    errors, file_sections, reviews, pending = prepare_reviews(paths)
+
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REVIEWS)
+    groups = group_sections(pending)
+    for group_reviews in await asyncio.gather(*(review_group(g, sem) for g in groups)):
+        reviews.update(group_reviews)
+
+    return [
+        errors[p] if p in errors else format_file_review(file_sections[p], reviews)
+        for p in paths
+    ]
+
+
+async def review_files_batch(paths):
+    """
+    Review all files through a single Batch API job.
+    Returns one result per path, in the same order as `paths`.
+    """
+    errors, file_sections, reviews, pending = prepare_reviews(paths)
+
+    groups = group_sections(pending)
+    lines = [
+        orjson.dumps({
+            "custom_id": f"group-{index}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_group_request(group),
+        })
+        for index, group in enumerate(groups)
+    ]
+
+    if lines:
+        batch_input = await client.files.create(
+            file=("ai_review_batch.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+            batch = await client.batches.retrieve(batch.id)
+
+        if batch.status != "completed":
+            raise RuntimeError(f"Review batch {batch.id} ended with status: {batch.status}")
+
+        # Failed requests land in the batch's error file (or carry a
+        # non-200 status here) and are reported as missing below
+        if batch.output_file_id:
+            output = await client.files.content(batch.output_file_id)
+            for line in output.content.splitlines():
+                record = orjson.loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                group = groups[int(record["custom_id"].removeprefix("group-"))]
+                choice = response["body"]["choices"][0]
+                group_reviews = parse_group_response(
+                    choice["message"]["content"], choice["finish_reason"]
+                )
+                store_group_reviews(group, group_reviews)
+                reviews.update(group_reviews)
+
+    return [
+        errors[p] if p in errors else format_file_review(file_sections[p], reviews)
+        for p in paths
+    ]
+
+
+async def run_review():
     print("### AI Code Review Report ###\n")
 
     changed_files = load_changed_files()
@@ -97,11 +483,16 @@ def run_review():
         print("No source files changed in this PR.")
         return
 
-    for f in source_files:
+    # Results come back in input order either way
+    if USE_BATCH_API:
+        results = await review_files_batch(source_files)
+    else:
+        results = await review_files(source_files)
+
+    for f, result in zip(source_files, results):
         print(f"\n--- Reviewing {f} ---\n")
-        result = review_file(f)
         print(result)
 
 
 if __name__ == "__main__":
-    run_review()
\ No newline at end of file
+    asyncio.run(run_review())
\ No newline at end of file
@@ -1,6 +1,7 @@
+import asyncio
+
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from typing import List
 
 app = FastAPI()
 
@@ -24,63 +25,90 @@ class Item(BaseModel):
     description: str | None = None
 
 
-# In‑memory "database"
-items_db: List[Item] = []
+# In‑memory "database", indexed by item ID
+items_db: dict[int, Item] = {}
+# Serializes mutations; reads are single dict operations and skip it
+items_lock = asyncio.Lock()
 
 
 # Home route
 @app.get("/")
-def home():
+async def home():
     return {"message": "Welcome to FastAPI!"}
 
 
 # GET all items
-@app.get("/items", response_model=List[Item])
-def get_items():
+# This and the write routes below are documented via `responses` rather
+# than `response_model`, so the Item instances they return (already
+# validated on the way in) are encoded directly instead of re-validated
+@app.get(
+    "/items",
+    response_model=None,
+    responses={200: {"model": list[Item]}}
+)
+async def get_items() -> list[Item]:
     n = 0
     x = 1 / n  # Intentional error to test GitHub CodeQL scanning
     print(x)
-    return items_db
+    return list(items_db.values())
 
 
 # GET single item by ID
 @app.get("/items/{item_id}", response_model=Item)
-def get_item(item_id: int):
-    for item in items_db:
-        if item.id == item_id:
-            return item
-    raise HTTPException(status_code=404, detail=ITEM_NOT_FOUND)
+async def get_item(item_id: int):
+    try:
+        return items_db[item_id]
+    except KeyError:
+        raise HTTPException(status_code=404, detail=ITEM_NOT_FOUND)
 
 
 # POST create new item
-@app.post("/items", response_model=Item)
-def create_item(item: Item):
-    # Basic ID uniqueness check
-    for existing in items_db:
-        if existing.id == item.id:
+@app.post(
+    "/items",
+    response_model=None,
+    responses={200: {"model": Item}}
+)
+async def create_item(item: Item) -> Item:
+    async with items_lock:
+        # Basic ID uniqueness check
+        if item.id in items_db:
             raise HTTPException(
                 status_code=400,
                 detail="Item ID already exists"
             )
-    items_db.append(item)
+        items_db[item.id] = item
     return item
 
 
 # PUT update item
-@app.put("/items/{item_id}", response_model=Item)
-def update_item(item_id: int, updated: Item):
-    for index, existing in enumerate(items_db):
-        if existing.id == item_id:
-            items_db[index] = updated
-            return updated
-    raise HTTPException(status_code=404, detail=ITEM_NOT_FOUND)
+@app.put(
+    "/items/{item_id}",
+    response_model=None,
+    responses={200: {"model": Item}}
+)
+async def update_item(item_id: int, updated: Item) -> Item:
+    async with items_lock:
+        if item_id not in items_db:
+            raise HTTPException(status_code=404, detail=ITEM_NOT_FOUND)
+        # Same uniqueness rule as create: never overwrite another item
+        if updated.id != item_id and updated.id in items_db:
+            raise HTTPException(
+                status_code=400,
+                detail="Item ID already exists"
+            )
+        if updated.id == item_id:
+            # Replace in place so the item keeps its position
+            items_db[item_id] = updated
+        else:
+            del items_db[item_id]
+            items_db[updated.id] = updated
+    return updated
 
 
 # DELETE item
 @app.delete("/items/{item_id}")
-def delete_item(item_id: int):
-    for index, existing in enumerate(items_db):
-        if existing.id == item_id:
-            del items_db[index]
-            return {"message": "Item deleted"}
-    raise HTTPException(status_code=404, detail=ITEM_NOT_FOUND)
+async def delete_item(item_id: int):
+    async with items_lock:
+        if items_db.pop(item_id, None) is None:
+            raise HTTPException(status_code=404, detail=ITEM_NOT_FOUND)
+    return {"message": "Item deleted"}